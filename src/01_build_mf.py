@@ -11,34 +11,74 @@
 #          --alpha     40 \
 #          --reg       0.01
 # ────────────────────────────────────────────────────────────────
-import argparse, json, os
+import argparse, os
+# implicit parallelises over users with OpenMP; keep BLAS single-threaded.
+# Must be set before numpy/implicit load their BLAS to take effect.
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
 from pathlib import Path
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import scipy.sparse as sp
 from implicit.cpu.als import AlternatingLeastSquares  # ALS model
 
+# typed ratings columns (skips dtype inference when parsing CSVs)
+RATING_TYPES = {
+    "userId"   : pa.int32(),
+    "movieId"  : pa.int32(),
+    "rating"   : pa.float32(),
+    "timestamp": pa.int64(),
+}
+
 # ────────────────────────────────────────────────────────────────
-def build_confidence(ratings: pd.DataFrame, user2row: dict, item2col: dict, alpha: float = 40.0) -> sp.coo_matrix:
+def read_ratings(path: str, columns: list[str] | None = None) -> pd.DataFrame:
+    """Read a ratings CSV with Arrow's multithreaded parser and fixed dtypes."""
+    opts = pacsv.ConvertOptions(column_types=RATING_TYPES, include_columns=columns)
+    return pacsv.read_csv(path, convert_options=opts).to_pandas()
+
+
+def factor_paths(prefix: str) -> tuple[Path, Path]:
+    """<prefix>_user.npy / <prefix>_item.npy (a trailing .npz is ignored)."""
+    p = Path(prefix)
+    stem = p.stem if p.suffix == ".npz" else p.name
+    return p.with_name(f"{stem}_user.npy"), p.with_name(f"{stem}_item.npy")
+
+
+def build_confidence(ratings: pd.DataFrame, user_ids: np.ndarray, item_ids: np.ndarray, alpha: float = 40.0) -> sp.csr_matrix:
     """
     Construct a confidence matrix from raw ratings using:
     C_ui = 1 + α · r_ui  (as per Hu et al., 2008)
+    Row/column order follows `user_ids` / `item_ids`.
+    The CSR arrays are built directly (no COO → CSR conversion pass).
     """
-    rows = ratings["userId"].map(user2row.get).astype(np.int32)
-    cols = ratings["movieId"].map(item2col.get).astype(np.int32)
-    vals = 1.0 + alpha * ratings["rating"].astype(np.float32)
-
-    return sp.coo_matrix(
-        (vals, (rows, cols)),
-        shape=(len(user2row), len(item2col)),
+    n_users, n_items = len(user_ids), len(item_ids)
+
+    # Categorical codes do the id → index lookup in pandas' C hashtable
+    rows = pd.Categorical(ratings["userId"], categories=user_ids).codes.astype(np.int32, copy=False)
+    cols = pd.Categorical(ratings["movieId"], categories=item_ids).codes.astype(np.int32, copy=False)
+    vals = np.add(1.0, alpha * ratings["rating"].to_numpy(np.float32), dtype=np.float32)
+
+    # Drop ids outside the index space (code == -1)
+    ok = (rows >= 0) & (cols >= 0)
+    if not ok.all():
+        rows, cols, vals = rows[ok], cols[ok], vals[ok]
+
+    # Row pointers from per-user counts, then bucket entries by row
+    indptr = np.zeros(n_users + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_users), out=indptr[1:])
+    order = np.argsort(rows, kind="stable")
+
+    C = sp.csr_matrix(
+        (vals[order], cols[order], indptr),
+        shape=(n_users, n_items),
         dtype=np.float32,
     )
+    C.sum_duplicates()  # repeated (user, item) pairs, as tocsr() used to do
+    return C
 
 # ────────────────────────────────────────────────────────────────
 def main() -> None:
-    # Limit number of BLAS threads to keep CPU calm
-    os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
-
     # Setup CLI arguments
     ap = argparse.ArgumentParser(
         description="Train an implicit-feedback ALS model (cpu.als)"
@@ -49,8 +89,10 @@ def main() -> None:
     ap.add_argument("--processed", default="data/processed/movies_processed.csv",
                     help="movies_processed.csv (defines item order)")
     # Output files
-    ap.add_argument("--out",       default="models/als_model.npz")
-    ap.add_argument("--mappings",  default="models/mf_mappings.json")
+    ap.add_argument("--out",       default="models/als_model",
+                    help="prefix for <out>_user.npy / <out>_item.npy")
+    ap.add_argument("--mappings",  default="models/mf_mappings.npz",
+                    help="row → userId / col → movieId arrays")
     # ALS hyperparameters
     ap.add_argument("--factors", type=int,   default=128)
     ap.add_argument("--iters",   type=int,   default=20)
@@ -65,7 +107,7 @@ def main() -> None:
 
     # ══════════ 1) Load data ════════════════════════════════════
     print("• loading ratings  …")
-    ratings = pd.read_csv(args.ratings)  # userId, movieId, rating
+    ratings = read_ratings(args.ratings)  # userId, movieId, rating
     print(f"  raw rows        : {len(ratings):,}")
 
     print("• loading metadata …")
@@ -78,30 +120,28 @@ def main() -> None:
     all_item_ids = movies["id"].values
 
     # ══════════ 2) Prune by user/item interaction counts ════════
-    if args.min_user_cnt > 0:
-        vc = ratings["userId"].value_counts()
-        keep_u = set(vc[vc >= args.min_user_cnt].index)
-        ratings = ratings[ratings.userId.isin(keep_u)]
-
-    if args.min_item_cnt > 0:
-        vc = ratings["movieId"].value_counts()
-        keep_i = set(vc[vc >= args.min_item_cnt].index)
-        ratings = ratings[ratings.movieId.isin(keep_i)]
+    # Both counts come from the loaded ratings; one fused mask applies them
+    uc = ratings["userId"].value_counts(sort=False)
+    ic = ratings["movieId"].value_counts(sort=False)
+    keep_u = uc.index.to_numpy()[uc.to_numpy() >= args.min_user_cnt]
+    keep_i = ic.index.to_numpy()[ic.to_numpy() >= args.min_item_cnt]
 
     # Keep only items present in processed metadata
-    ratings = ratings[ratings.movieId.isin(all_item_ids)]
+    keep_i = np.intersect1d(keep_i, all_item_ids)
+
+    mask = (np.isin(ratings["userId"].to_numpy(), keep_u)
+            & np.isin(ratings["movieId"].to_numpy(), keep_i))
+    ratings = ratings[mask]
     print(f"  kept rows       : {len(ratings):,}")
 
     # ══════════ 3) Build user/item index maps ═══════════════════
     user_ids = ratings["userId"].unique()        # unordered
     item_ids = all_item_ids                      # preserve metadata order
 
-    user2row = {uid: i for i, uid in enumerate(user_ids)}
-    item2col = {iid: i for i, iid in enumerate(item_ids)}
-    print(f"  users={len(user2row):,}  items={len(item2col):,}")
+    print(f"  users={len(user_ids):,}  items={len(item_ids):,}")
 
     # ══════════ 4) Build sparse confidence matrix ═══════════════
-    C = build_confidence(ratings, user2row, item2col, alpha=args.alpha)
+    C = build_confidence(ratings, user_ids, item_ids, alpha=args.alpha)
 
     # ══════════ 5) Train ALS model ══════════════════════════════
     print(f"• training ALS  (factors={args.factors}  iters={args.iters}) …")
@@ -109,27 +149,26 @@ def main() -> None:
         factors=args.factors,
         regularization=args.reg,
         iterations=args.iters,
+        use_native=True,                # compiled OpenMP solver
+        use_cg=True,                    # conjugate gradient, not Cholesky
+        calculate_training_loss=False,  # skip the full loss pass per iteration
+        num_threads=0,                  # all cores
     )
-    # Use CSR format for fast training
-    als.fit(C.tocsr(), show_progress=True)
+    als.fit(C, show_progress=True)
 
     # ══════════ 6) Save model artefacts ═════════════════════════
-    # Save user/item embeddings
-    Path(args.out).parent.mkdir(parents=True, exist_ok=True)
-    np.savez(args.out,
-             user_factors=als.user_factors.astype(np.float32),
-             item_factors=als.item_factors.astype(np.float32))
-    print(f"✔ factors saved  →  {args.out}")
-
-    # Save id-to-index mappings (and reverse)
-    mappings = {
-        "user2row": {int(k): int(v) for k, v in user2row.items()},
-        "item2col": {int(k): int(v) for k, v in item2col.items()},
-        "row2user": {int(v): int(k) for k, v in user2row.items()},
-        "col2item": {int(v): int(k) for k, v in item2col.items()},
-    }
+    # Save user/item embeddings as raw .npy so consumers can memory-map them
+    user_path, item_path = factor_paths(args.out)
+    user_path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(user_path, als.user_factors.astype(np.float32))
+    np.save(item_path, als.item_factors.astype(np.float32))
+    print(f"✔ factors saved  →  {user_path}, {item_path}")
+
+    # Save id mappings: array position is the factor row / column
     Path(args.mappings).parent.mkdir(parents=True, exist_ok=True)
-    Path(args.mappings).write_text(json.dumps(mappings))
+    np.savez(args.mappings,
+             user_ids=np.asarray(user_ids, dtype=np.int32),
+             item_ids=np.asarray(item_ids, dtype=np.int32))
     print(f"✔ mappings saved →  {args.mappings}")
 
 # ────────────────────────────────────────────────────────────────
@@ -10,21 +10,44 @@
 #          --seen data/tmp/valid_ratings.csv \
 #          --output data/processed/candidates_valid.parquet
 # ────────────────────────────────────────────────────────────────
-import argparse, json
+import argparse
 from pathlib import Path
 from typing  import List, Dict, Tuple
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import faiss
 from tqdm import tqdm
 
+# typed ratings columns (skips dtype inference when parsing CSVs)
+RATING_TYPES = {
+    "userId"   : pa.int32(),
+    "movieId"  : pa.int32(),
+    "rating"   : pa.float32(),
+    "timestamp": pa.int64(),
+}
+
 # ────────────────────────────────────────────────────────────────
 # utilities
 # ────────────────────────────────────────────────────────────────
+def read_ratings(path: str, columns: list[str] | None = None) -> pd.DataFrame:
+    """Read a ratings CSV with Arrow's multithreaded parser and fixed dtypes."""
+    opts = pacsv.ConvertOptions(column_types=RATING_TYPES, include_columns=columns)
+    return pacsv.read_csv(path, convert_options=opts).to_pandas()
+
+
+def factor_paths(prefix: str) -> tuple[Path, Path]:
+    """<prefix>_user.npy / <prefix>_item.npy (a trailing .npz is ignored)."""
+    p = Path(prefix)
+    stem = p.stem if p.suffix == ".npz" else p.name
+    return p.with_name(f"{stem}_user.npy"), p.with_name(f"{stem}_item.npy")
+
+
 def load_als(als_path: str) -> Tuple[np.ndarray, np.ndarray]:
-    """Return (user_factors, item_factors) as float32."""
-    data = np.load(als_path)
-    return data["user_factors"].astype("float32"), data["item_factors"].astype("float32")
+    """Memory-map (user_factors, item_factors); only touched rows are paged in."""
+    user_path, item_path = factor_paths(als_path)
+    return np.load(user_path, mmap_mode="r"), np.load(item_path, mmap_mode="r")
 
 
 def build_ip_index(vecs: np.ndarray) -> faiss.IndexFlatIP:
@@ -46,7 +69,8 @@ def recall_mf(u_row: int, U: np.ndarray, idx_mf: faiss.Index, R: int, seen: set)
     q = U[u_row:u_row + 1].copy()
     faiss.normalize_L2(q)
     _, rows = idx_mf.search(q, R + len(seen) + 50)          # over-fetch
-    return mask_seen(rows[0], seen)[:R]                     # row indices
+    rows = rows[0][rows[0] >= 0]                            # drop -1 padding (k > ntotal)
+    return mask_seen(rows, seen)[:R]                        # row indices
 
 
 def merge_lists(mf: np.ndarray, ct: np.ndarray, how: str, w_mf: float, w_ct: float, R: int) -> np.ndarray:
@@ -87,8 +111,9 @@ def merge_lists(mf: np.ndarray, ct: np.ndarray, how: str, w_mf: float, w_ct: flo
 # ────────────────────────────────────────────────────────────────
 def main() -> None:
     p = argparse.ArgumentParser(description="ALS-based recall → candidate parquet")
-    p.add_argument("--als",    default="models/als_model.npz")
-    p.add_argument("--maps",   default="models/mf_mappings.json")
+    p.add_argument("--als",    default="models/als_model",
+                   help="factor prefix written by 01_build_mf.py")
+    p.add_argument("--maps",   default="models/mf_mappings.npz")
     p.add_argument("--seen",   required=True, help="ratings csv for seen-mask")
     p.add_argument("--user",   type=int)                       # optional single user
     p.add_argument("--topR",   type=int, default=300)
@@ -106,10 +131,9 @@ def main() -> None:
 
     # ── 1)  load matrices & mappings ───────────────────────────
     U, V = load_als(args.als)
-    maps = json.loads(Path(args.maps).read_text())
-    user2row = {int(u): int(r) for u, r in maps["user2row"].items()}
-    item2row = {int(i): int(c) for i, c in maps["item2col"].items()}
-    row2item = {r: i for i, r in item2row.items()}
+    maps = np.load(args.maps)
+    item_ids = maps["item_ids"]                                   # row → tmdbId
+    user2row = {int(u): r for r, u in enumerate(maps["user_ids"])}
 
     idx_mf = build_ip_index(V.copy())
 
@@ -118,7 +142,7 @@ def main() -> None:
     # ── 2)  seen-mask ──────────────────────────────────────────
     seen_map: Dict[int, set] = {}
     if args.seen:
-        seen_df = pd.read_csv(args.seen, usecols=["userId", "movieId"])
+        seen_df = read_ratings(args.seen, columns=["userId", "movieId"])
         seen_map = seen_df.groupby("userId")["movieId"].apply(set).to_dict()
 
     # target users
@@ -135,19 +159,16 @@ def main() -> None:
 
         # ----- MF recall (row indices) -------------------------
         mf_rows = recall_mf(urow, U, idx_mf, args.topR, seen)
-        mf_items = np.vectorize(row2item.get)(mf_rows)
+        mf_items = item_ids[mf_rows].astype(np.int64)
 
         # ----- optional content neighbours ---------------------
         if idx_ct is not None and mf_rows.size:
-            seed_item_id = mf_items[0]                 # tmdbId
-            seed_row     = item2row.get(seed_item_id)  # row in content index
-            if seed_row is not None:
-                seed_vec = idx_ct.reconstruct(seed_row).astype("float32")
-                faiss.normalize_L2(seed_vec.reshape(1, -1))
-                _, ct_rows = idx_ct.search(seed_vec.reshape(1, -1), args.content_top)
-                ct_items = np.vectorize(row2item.get)(ct_rows[0])
-            else:
-                ct_items = np.empty(0, dtype=np.int64)
+            seed_row = int(mf_rows[0])                 # row of the top MF item
+            seed_vec = idx_ct.reconstruct(seed_row).astype("float32")
+            faiss.normalize_L2(seed_vec.reshape(1, -1))
+            _, ct_rows = idx_ct.search(seed_vec.reshape(1, -1), args.content_top)
+            ct_rows  = ct_rows[0][(ct_rows[0] >= 0) & (ct_rows[0] < item_ids.size)]
+            ct_items = item_ids[ct_rows].astype(np.int64)
             cand = merge_lists(mf_items, ct_items, args.merge,
                                args.weight_mf, args.weight_ct, args.topR)
         else:
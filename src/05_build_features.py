@@ -22,51 +22,267 @@
 # ────────────────────────────────────────────────────────────────
 import argparse
 from pathlib import Path
-from typing import List, Dict, Set
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from numba import njit, prange
+
+# feature columns taken from movies_processed.csv → output column names
+FEATURES = {
+    "runtime_z"   : "runtime_z",
+    "lang_idx"    : "lang_idx",
+    "popularity"  : "popularity",
+    "vote_average": "vote_avg",
+    "vote_count"  : "vote_cnt",
+}
+
+# typed ratings columns (skips dtype inference when parsing CSVs)
+RATING_TYPES = {
+    "userId"   : pa.int32(),
+    "movieId"  : pa.int32(),
+    "rating"   : pa.float32(),
+    "timestamp": pa.int64(),
+}
+
+# typed layout of the output parquet
+SCHEMA = pa.schema([
+    ("userId",     pa.int32()),
+    ("movieId",    pa.int32()),
+    ("label",      pa.int8()),
+    ("runtime_z",  pa.float32()),
+    ("lang_idx",   pa.int16()),
+    ("popularity", pa.float32()),
+    ("vote_avg",   pa.float32()),
+    ("vote_cnt",   pa.int32()),
+])
 
 # ────────────────────────────────────────────────────────────────
 # helpers
 # ────────────────────────────────────────────────────────────────
 
-def sample_easy_neg(seen: Set[int], pop_items: np.ndarray, n: int, rng: np.random.Generator) -> List[int]:
+def read_ratings(path: str, columns: list[str] | None = None) -> pd.DataFrame:
+    """Read a ratings CSV with Arrow's multithreaded parser and fixed dtypes."""
+    opts = pacsv.ConvertOptions(column_types=RATING_TYPES, include_columns=columns)
+    return pacsv.read_csv(path, convert_options=opts).to_pandas()
+
+
+def read_candidates(path: str) -> tuple[np.ndarray, np.ndarray]:
     """
-    Sample `n` unseen items with probability ∝ popularity.
-    Uses a seeded RNG to ensure reproducibility.
-    Mutates the `seen` set in-place to avoid duplicates.
+    Flatten the candidate-list parquet into aligned (userId, movieId) int64
+    arrays in recall order, straight from Arrow buffers (no boxed ints).
     """
-    if n == 0 or pop_items.size == 0:
-        return []
-    out: List[int] = []
-    while len(out) < n:
-        item = int(rng.choice(pop_items, 1)[0])
-        if item not in seen:
-            out.append(item)
-            seen.add(item)
-    return out
-
-
-def make_row(uid: int, item: int, label: int, meta: pd.Series | None) -> Dict | None:
+    table = pq.read_table(path, columns=["userId", "candidates"])
+    lists = table.column("candidates").combine_chunks()
+    flat  = lists.flatten()
+    owner = pc.list_parent_indices(lists).to_numpy()
+    valid = flat.is_valid().to_numpy(zero_copy_only=False)
+    uids  = table.column("userId").to_numpy().astype(np.int64)[owner[valid]]
+    items = flat.filter(valid).to_numpy().astype(np.int64)
+    return uids, items
+
+
+def build_alias(weights: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
     """
-    Assemble a feature dictionary for a single (user, item) interaction.
-    Returns None if movie metadata is missing.
+    Build a Walker/Vose alias table (J, q) for O(1) weighted sampling.
+    Slot i is kept with probability q[i], otherwise its alias J[i] is taken.
     """
-    if meta is None:
-        return None
-    # Optionally compute recency — disabled for now.
-    return dict(
-        userId       = uid,
-        movieId      = item,
-        label        = label,
-        runtime_z    = meta["runtime_z"],
-        lang_idx     = meta["lang_idx"],
-        popularity   = meta["popularity"],
-        vote_avg     = meta["vote_average"],
-        vote_cnt     = meta["vote_count"],
-        # recency_days = recency,
-    )
+    K = weights.size
+    prob = weights.astype(np.float64) * (K / weights.sum())
+    J = np.arange(K, dtype=np.int64)
+    q = np.ones(K, dtype=np.float64)
+    small = np.flatnonzero(prob < 1.0).tolist()
+    large = np.flatnonzero(prob >= 1.0).tolist()
+    while small and large:
+        s, l = small.pop(), large.pop()
+        J[s], q[s] = l, prob[s]
+        prob[l] += prob[s] - 1.0
+        (small if prob[l] < 1.0 else large).append(l)
+    return J, q  # leftovers keep q = 1 (numerical slack)
+
+
+def sample_alias(J: np.ndarray, q: np.ndarray, size, rng: np.random.Generator) -> np.ndarray:
+    """Draw `size` slot indices from an alias table in one vectorised pass."""
+    i = rng.integers(0, J.size, size=size)
+    return np.where(rng.random(size) >= q[i], J[i], i)
+
+
+@njit(cache=True)
+def _is_seen(seen: np.ndarray, item: int) -> bool:
+    """Binary search in the user's sorted rated-item slice."""
+    j = np.searchsorted(seen, item)
+    return j < seen.size and seen[j] == item
+
+
+@njit(parallel=True, cache=True)
+def _pick_easy(todo, seen_lo, seen_hi, seen_items, draws, picks, taken):
+    """
+    Extend each listed user's distinct unseen picks from one block of
+    alias draws (`draws[j]` belongs to user `todo[j]`); updates in place.
+    """
+    n_pick = picks.shape[1]
+    for j in prange(todo.size):
+        u = todo[j]
+        seen = seen_items[seen_lo[u]:seen_hi[u]]
+        t = taken[u]
+        for it in draws[j]:
+            if t == n_pick:
+                break
+            if not _is_seen(seen, it) and not (picks[u, :t] == it).any():
+                picks[u, t] = it
+                t += 1
+        taken[u] = t
+
+
+def pick_easy_negatives(seen_lo, seen_hi, seen_items, pop_items, pop_weights, alias,
+                        n_pick: int, rng: np.random.Generator, max_rounds: int = 8):
+    """
+    Pick up to `n_pick` distinct unseen items per user, ∝ popularity, i.e.
+    sequential weighted draws with rejection of seen items and repeats.
+    Returns (picks, taken); taken[u] == min(n_pick, #unseen items of u).
+
+    Starts with a 4× block of alias draws per user and re-draws doubling
+    blocks for users still short; the few left after `max_rounds` (nearly
+    everything popular already rated) get an exact weighted draw without
+    replacement from their remaining unseen items.
+    """
+    n_users = seen_lo.size
+    picks = np.full((n_users, n_pick), -1, dtype=np.int64)
+    taken = np.zeros(n_users, dtype=np.int64)
+    # every rated item is in pop_items, so #unseen = K - #distinct rated
+    target = np.minimum(n_pick, pop_items.size - (seen_hi - seen_lo))
+    if n_pick == 0:
+        return picks, taken
+
+    todo, width = np.flatnonzero(target > 0), 4 * n_pick
+    for _ in range(max_rounds):
+        if todo.size == 0:
+            break
+        draws = pop_items[sample_alias(*alias, (todo.size, width), rng)].astype(np.int64)
+        _pick_easy(todo, seen_lo, seen_hi, seen_items, draws, picks, taken)
+        todo = todo[taken[todo] < target[todo]]
+        width *= 2
+
+    for u in todo:
+        t = taken[u]
+        excl = np.concatenate([seen_items[seen_lo[u]:seen_hi[u]], picks[u, :t]])
+        free = ~np.isin(pop_items, excl)
+        w = pop_weights[free]
+        picks[u, t:target[u]] = rng.choice(pop_items[free], size=target[u] - t,
+                                           replace=False, p=w / w.sum())
+        taken[u] = target[u]
+    return picks, taken
+
+
+@njit(cache=True)
+def _user_negatives(seen, cand, picks, pick_known, n_taken, n_hard, n_easy, out) -> int:
+    """
+    Write one user's negatives into `out` (hard first, then easy) and
+    return how many were written.
+    - hard: first `n_hard` unseen candidates (already filtered to metadata)
+    - easy: first `n_easy` easy picks, kept if they have metadata
+    - fallback: the extra pick when neither produced a negative
+    """
+    k = 0
+    for it in cand:
+        if k == n_hard:
+            break
+        if not _is_seen(seen, it):
+            out[k] = it
+            k += 1
+
+    for i in range(min(n_taken, n_easy)):
+        if pick_known[i]:
+            out[k] = picks[i]
+            k += 1
+
+    if k == 0 and n_taken > n_easy and pick_known[n_easy]:
+        out[k] = picks[n_easy]
+        k += 1
+    return k
+
+
+@njit(parallel=True, cache=True)
+def _count_rows(seen_lo, seen_hi, seen_items, pos_off, cand_lo, cand_hi, cand_items,
+                picks, pick_known, taken, n_hard, n_easy):
+    """Rows per user (positives + negatives); 0 when a user has no negatives."""
+    n_users = pos_off.size - 1
+    counts = np.zeros(n_users, dtype=np.int64)
+    for u in prange(n_users):
+        buf = np.empty(n_hard + n_easy + 1, dtype=np.int64)
+        n_neg = _user_negatives(seen_items[seen_lo[u]:seen_hi[u]],
+                                cand_items[cand_lo[u]:cand_hi[u]],
+                                picks[u], pick_known[u], taken[u], n_hard, n_easy, buf)
+        if n_neg > 0:
+            counts[u] = pos_off[u + 1] - pos_off[u] + n_neg
+    return counts
+
+
+@njit(parallel=True, cache=True)
+def _fill_rows(seen_lo, seen_hi, seen_items, pos_off, pos_items, cand_lo, cand_hi, cand_items,
+               picks, pick_known, taken, n_hard, n_easy, out_off, out_user, out_item, out_label):
+    """Fill the preallocated output arrays, one user slice per thread."""
+    n_users = pos_off.size - 1
+    for u in prange(n_users):
+        o = out_off[u]
+        if out_off[u + 1] == o:
+            continue
+        for p in range(pos_off[u], pos_off[u + 1]):
+            out_item[o] = pos_items[p]
+            out_label[o] = 1
+            o += 1
+        _user_negatives(seen_items[seen_lo[u]:seen_hi[u]],
+                        cand_items[cand_lo[u]:cand_hi[u]],
+                        picks[u], pick_known[u], taken[u], n_hard, n_easy, out_item[o:])
+        out_user[out_off[u]:out_off[u + 1]] = u
+
+
+def assemble_rows(seen_lo, seen_hi, seen_items, pos_off, pos_items, cand_lo, cand_hi, cand_items,
+                  picks, pick_known, taken, n_hard: int, n_easy: int):
+    """
+    Run the per-user kernels and return (user_idx, movieId, label) arrays,
+    grouped by user with positives → hard → easy inside each group.
+    All ragged inputs are indexed by user position (see main).
+    """
+    counts = _count_rows(seen_lo, seen_hi, seen_items, pos_off, cand_lo, cand_hi, cand_items,
+                         picks, pick_known, taken, n_hard, n_easy)
+    out_off = np.zeros(counts.size + 1, dtype=np.int64)
+    np.cumsum(counts, out=out_off[1:])
+
+    n_rows = int(out_off[-1])
+    out_user  = np.empty(n_rows, dtype=np.int64)
+    out_item  = np.empty(n_rows, dtype=np.int64)
+    out_label = np.zeros(n_rows, dtype=np.int8)
+    _fill_rows(seen_lo, seen_hi, seen_items, pos_off, pos_items, cand_lo, cand_hi, cand_items,
+               picks, pick_known, taken, n_hard, n_easy, out_off, out_user, out_item, out_label)
+    return out_user, out_item, out_label
+
+
+def write_rows(path: str, users: np.ndarray, user_idx: np.ndarray, items: np.ndarray,
+               labels: np.ndarray, item_pos: np.ndarray, feat_arrays: dict,
+               chunk_users: int) -> None:
+    """
+    Stream the assembled rows to parquet, one RecordBatch per `chunk_users`
+    users, so only one chunk of typed columns is materialised at a time.
+    Feature columns are gathered from the SoA by `item_pos`.
+    """
+    edges = np.append(np.searchsorted(user_idx, np.arange(0, users.size, chunk_users)), user_idx.size)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with pq.ParquetWriter(path, SCHEMA, compression="zstd") as writer:
+        for lo, hi in zip(edges[:-1], edges[1:]):
+            cols = {
+                "userId" : users[user_idx[lo:hi]],
+                "movieId": items[lo:hi],
+                "label"  : labels[lo:hi],
+                **{name: arr[item_pos[lo:hi]] for name, arr in feat_arrays.items()},
+            }
+            writer.write_batch(pa.RecordBatch.from_arrays(
+                [pa.array(cols[f.name].astype(f.type.to_pandas_dtype(), copy=False), type=f.type)
+                 for f in SCHEMA],
+                schema=SCHEMA,
+            ))
 
 # ────────────────────────────────────────────────────────────────
 # main
@@ -94,6 +310,8 @@ def main() -> None:
                     help="Star rating ≥ THRESH counts as positive")
     ap.add_argument("--seed", type=int, default=42,
                     help="RNG seed for deterministic sampling")
+    ap.add_argument("--chunk-users", type=int, default=10_000,
+                    help="Users per parquet record batch")
     args = ap.parse_args()
 
     # Initialize random number generator
@@ -101,90 +319,72 @@ def main() -> None:
 
     # ── load data ───────────────────────────────────────────────
     print("loading data …")
-    ratings  = pd.read_csv(args.ratings)  # contains userId, movieId, rating, timestamp
+    ratings  = read_ratings(args.ratings)  # contains userId, movieId, rating, timestamp
     movies   = pd.read_csv(args.movies).set_index("id")  # metadata for items
-    cand_map = (pd.read_parquet(args.candidates)  # userId → candidate movie list
-                .set_index("userId")["candidates"].to_dict())
-    pop_items = ratings["movieId"].value_counts().index.values  # popular items
-
-    rows: List[Dict] = []
-    kept_users = 0  # count of users who contributed rows
-
-    # ── process each user ───────────────────────────────────────
-    for uid, grp in tqdm(ratings.groupby("userId"), unit="user", desc="users"):
-        # Get user's positive interactions (rating ≥ threshold)
-        pos_items = grp[grp["rating"] >= args.pos_thresh].sort_values("timestamp")
-        if pos_items.empty:
-            continue  # skip user if no positives
-
-        seen_items = set(grp["movieId"].values)  # all rated items for masking
-
-        # Create rows for each positive item
-        pos_rows = []
-        for it, ts in zip(pos_items["movieId"].values,
-                          pos_items["timestamp"].values):
-            if it in movies.index:
-                meta = movies.loc[it]
-                r = make_row(uid, it, 1, meta, ts)
-                if r:
-                    pos_rows.append(r)
-
-        if not pos_rows:
-            continue  # skip user if metadata is missing for all positives
-
-        # ── sample negatives ─────────────────────────────────────
-
-        # Hard negatives: from model-generated candidates
-        hard_neg = [i for i in cand_map.get(uid, [])
-                    if i not in seen_items and i in movies.index][:args.hard_neg]
-
-        # Easy negatives: popularity-based sampling
-        easy_neg_ids = sample_easy_neg(seen_items.copy(),
-                                       pop_items,
-                                       args.easy_neg,
-                                       rng)
-        easy_neg = [i for i in easy_neg_ids if i in movies.index]
-
-        # Fallback: sample 1 if no negatives found
-        if not (hard_neg or easy_neg):
-            fallback = sample_easy_neg(seen_items.copy(),
-                                       pop_items,
-                                       1,
-                                       rng)
-            easy_neg = [i for i in fallback if i in movies.index]
-
-        # Create negative rows (label=0)
-        neg_rows = []
-        for it in hard_neg + easy_neg:
-            meta = movies.loc[it]
-            neg_rows.append(make_row(uid, it, 0, meta, None))
-
-        if not neg_rows:
-            continue  # still no usable negatives
-
-        rows.extend(pos_rows)
-        rows.extend(neg_rows)
-        kept_users += 1
-
-    # Convert list of rows to DataFrame
-    df = pd.DataFrame(rows)
+    movies   = movies[~movies.index.duplicated()]
+    # Struct-of-arrays view of the item features, addressed by row position
+    # (already in the narrow output dtypes, so chunk gathers move fewer bytes)
+    feat_arrays = {out: movies[col].to_numpy(SCHEMA.field(out).type.to_pandas_dtype())
+                   for col, out in FEATURES.items()}
+    cand_uid, cand_items = read_candidates(args.candidates)  # userId → candidate movies
+    # Easy-negative sampler: items weighted by their rating count
+    pop_counts  = ratings["movieId"].value_counts()
+    pop_items   = pop_counts.index.to_numpy()
+    pop_weights = pop_counts.to_numpy(np.float64)
+    pop_weights /= pop_weights.sum()
+    alias       = build_alias(pop_weights)
+
+    # ── positives (rating ≥ threshold, with metadata) ───────────
+    pos = ratings.loc[(ratings["rating"] >= args.pos_thresh)
+                      & ratings["movieId"].isin(movies.index),
+                      ["userId", "movieId", "timestamp"]]
+    pos = pos.sort_values(["userId", "timestamp"], kind="stable")
+    pos_uid = pos["userId"].to_numpy(np.int64)
+    users   = np.unique(pos_uid)  # users with ≥1 usable positive
+    pos_off = np.append(np.searchsorted(pos_uid, users), pos_uid.size)
+
+    # ── ragged per-user inputs (sorted by userId) ───────────────
+    # Distinct seen items, sorted within each user for binary search
+    seen = ratings[["userId", "movieId"]].drop_duplicates().sort_values(["userId", "movieId"])
+    seen_uid   = seen["userId"].to_numpy(np.int64)
+    seen_items = seen["movieId"].to_numpy(np.int64)
+    seen_lo, seen_hi = np.searchsorted(seen_uid, users, "left"), np.searchsorted(seen_uid, users, "right")
+
+    # Hard negatives: model-generated candidates with metadata, in candidate order
+    keep = np.isin(cand_uid, users) & (movies.index.get_indexer(cand_items) >= 0)
+    order = np.argsort(cand_uid[keep], kind="stable")
+    cand_uid, cand_items = cand_uid[keep][order], cand_items[keep][order]
+    cand_lo, cand_hi = np.searchsorted(cand_uid, users, "left"), np.searchsorted(cand_uid, users, "right")
+
+    # Easy negatives: n distinct unseen popularity draws per user, +1 for the fallback
+    picks, taken = pick_easy_negatives(seen_lo, seen_hi, seen_items, pop_items, pop_weights,
+                                       alias, args.easy_neg + 1, rng)
+    n_unseen = pop_items.size - (seen_hi - seen_lo)
+    assert (np.minimum(taken, args.easy_neg) == np.minimum(args.easy_neg, n_unseen)).all(), \
+        "easy-negative shortfall"
+    pick_known = movies.index.get_indexer(picks.ravel()).reshape(picks.shape) >= 0
+
+    # ── assemble rows ───────────────────────────────────────────
+    user_idx, items, labels = assemble_rows(
+        seen_lo, seen_hi, seen_items,
+        pos_off, pos["movieId"].to_numpy(np.int64),
+        cand_lo, cand_hi, cand_items,
+        picks, pick_known, taken, args.hard_neg, args.easy_neg,
+    )
+
+    kept_users = np.unique(user_idx).size  # count of users who contributed rows
     print(f"users kept : {kept_users:,}")
-    print(f"rows       : {len(df):,}")
+    print(f"rows       : {items.size:,}")
 
     # ── write output ────────────────────────────────────────────
-    def _save(path: str, label: str):
-        if str(path).lower() in {"none", "null", "nul", "/dev/null", "-"}:
-            print(f"{label} set not written (null path)")
-            return
-        Path(path).parent.mkdir(parents=True, exist_ok=True)
-        df.to_parquet(path, index=False)
-        print(f"saved → {path}")
-
-    # Save to appropriate split
-    if args.set == "train":
-        _save(args.out_train, "train")
-    else:
-        _save(args.out_valid, "valid")
+    path = args.out_train if args.set == "train" else args.out_valid
+    if str(path).lower() in {"none", "null", "nul", "/dev/null", "-"}:
+        print(f"{args.set} set not written (null path)")
+        return
+
+    item_pos = movies.index.get_indexer(items)
+    write_rows(path, users, user_idx, items, labels, item_pos, feat_arrays, args.chunk_users)
+    print(f"saved → {path}")
 
 # ────────────────────────────────────────────────────────────────
 if __name__ == "__main__":
@@ -4,12 +4,12 @@
 # example:
 #   python src/06_train_lgbm.py
 # ──────────────────────────────────────────────────────────────── 
-import argparse, time
+import argparse, gc, os, time
 from pathlib import Path
 import lightgbm as lgb
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
+from numba import njit, prange
 
 # ────────────────────────────────────────────────────────────────
 # helper
@@ -25,16 +25,13 @@ def load_split(path: str):
     # Filter users who have at least one positive and one negative
     stats = df.groupby("userId")["label"].agg(["sum", "count"])
     ok    = stats[(stats["sum"] > 0) & (stats["sum"] < stats["count"])].index
-    df    = df[df.userId.isin(ok)].reset_index(drop=True)
-
-    # Compute group sizes for LightGBM's ranking objective
-    grp_sizes = (
-        df.groupby("userId", sort=False)["movieId"]
-          .size()
-          .astype("int32")
-          .to_list()
-    )
-    assert sum(grp_sizes) == len(df), "group size mismatch"
+    df    = df[df.userId.isin(ok)]
+
+    # Rows must be contiguous per user; group sizes come from run starts
+    df = df.sort_values("userId", kind="stable", ignore_index=True)
+    _, starts = np.unique(df["userId"].to_numpy(), return_index=True)
+    grp_sizes = np.diff(np.append(starts, len(df))).astype(np.int32)
+    assert grp_sizes.sum() == len(df), "group size mismatch"
     return df, grp_sizes
 
 
@@ -44,32 +41,69 @@ def lgb_dataset(df: pd.DataFrame, group_sizes, cat_feat_name: str):
     - Drops userId, movieId, label
     - Identifies categorical feature index
     """
-    X_df = (
-        df.drop(columns=["userId", "movieId", "label"])
-          .reset_index(drop=True)
-    )
-    feat_names = X_df.columns.tolist()
+    feat_names = [c for c in df.columns if c not in ("userId", "movieId", "label")]
     cat_idx = [feat_names.index(cat_feat_name)]
 
-    X = X_df.values.astype(np.float32)
-    y = df["label"].astype(int).values
+    # Cast column by column straight into one float32 matrix
+    # (mixed int/float columns would otherwise go via a float64 copy)
+    X = np.empty((len(df), len(feat_names)), dtype=np.float32)
+    for j, col in enumerate(feat_names):
+        X[:, j] = df[col].to_numpy(copy=False)
+    y = df["label"].to_numpy()  # int8 as written by build_features
 
     dset = lgb.Dataset(
         X,
         label=y,
         group=group_sizes,
-        free_raw_data=False,
+        free_raw_data=True,     # release X once LightGBM has binned it
         categorical_feature=cat_idx,
     )
     return dset, feat_names, cat_idx
 
 
-def _dcg(rels: np.ndarray) -> float:
-    """
-    Compute Discounted Cumulative Gain
-    Assumes binary relevance (0/1) with log2 rank discount
-    """
-    return float((rels / np.log2(np.arange(2, rels.size + 2))).sum())
+@njit(parallel=True, cache=True)
+def eval_kernel(starts, ends, label, pred, k, disc):
+    """Per-user AP@k and NDCG@k over contiguous user slices [starts, ends)"""
+    n_users = starts.size
+    ap   = np.zeros(n_users)
+    ndcg = np.zeros(n_users)
+    for u in prange(n_users):
+        lo, hi = starts[u], ends[u]
+        n_pos = 0
+        for i in range(lo, hi):
+            if label[i] > 0:
+                n_pos += 1
+        if n_pos == 0:                         # no positives → contributes 0
+            continue
+
+        # Bounded top-k by insertion sort (ties keep row order)
+        top = np.empty(k, dtype=np.int64)
+        m = 0
+        for i in range(lo, hi):
+            if m == k and pred[i] <= pred[top[m - 1]]:
+                continue
+            j = m if m < k else k - 1
+            while j > 0 and pred[top[j - 1]] < pred[i]:
+                top[j] = top[j - 1]
+                j -= 1
+            top[j] = i
+            if m < k:
+                m += 1
+
+        hits, ap_sum, dcg = 0, 0.0, 0.0
+        for r in range(m):
+            if label[top[r]] > 0:
+                hits += 1
+                ap_sum += hits / (r + 1)
+                dcg += disc[r]
+
+        n_rel = min(n_pos, k)
+        idcg = 0.0
+        for r in range(n_rel):
+            idcg += disc[r]
+        ap[u]   = ap_sum / n_rel
+        ndcg[u] = dcg / idcg
+    return ap, ndcg
 
 
 def eval_metrics(df_pred, k: int = 10) -> tuple[float, float]:
@@ -78,38 +112,17 @@ def eval_metrics(df_pred, k: int = 10) -> tuple[float, float]:
     - If a user has no positives, they contribute 0 to both metrics
     - IDCG is computed from full relevance vector for fair comparison
     """
-    map_scores, ndcg_scores = [], []
+    df = df_pred.sort_values("userId", kind="stable")
+    if len(df) == 0:
+        return 0.0, 0.0
 
-    for _, g in tqdm(df_pred.groupby("userId"), desc="eval", unit="usr", leave=False):
-        y_true = g["label"].to_numpy(dtype=np.int8, copy=False)
-        y_pred = g["pred"].to_numpy(copy=False)
-
-        if y_true.sum() == 0:  # skip users with no positives
-            map_scores.append(0.0)
-            ndcg_scores.append(0.0)
-            continue
-
-        # Get top-k predicted indices
-        order = y_pred.argsort()[::-1]
-        topk  = order[:k]
-
-        # ---------- MAP@k ----------
-        hits = y_true[topk]
-        if hits.sum() == 0:
-            map_scores.append(0.0)
-        else:
-            cumsum = np.cumsum(hits)
-            precision_at_i = cumsum / (np.arange(k) + 1)
-            ap = (precision_at_i * hits).sum() / min(y_true.sum(), k)
-            map_scores.append(float(ap))
-
-        # ---------- NDCG@k ----------
-        dcg  = _dcg(y_true[topk])
-        ideal_topk = np.sort(y_true)[::-1][:k]
-        idcg = _dcg(ideal_topk)
-        ndcg_scores.append(dcg / idcg if idcg > 0 else 0.0)
-
-    return float(np.mean(map_scores)), float(np.mean(ndcg_scores))
+    _, starts, sizes = np.unique(df["userId"].to_numpy(), return_index=True, return_counts=True)
+    disc = 1.0 / np.log2(np.arange(2, k + 2))  # shared DCG discounts
+    ap, ndcg = eval_kernel(starts, starts + sizes,
+                           df["label"].to_numpy(np.int8),
+                           df["pred"].to_numpy(np.float64),
+                           k, disc)
+    return float(ap.mean()), float(ndcg.mean())
 
 
 # ────────────────────────────────────────────────────────────────
@@ -127,6 +140,8 @@ def main():
     ap.add_argument("--trees",   type=int,   default=500)
     ap.add_argument("--lr",      type=float, default=0.05)
     ap.add_argument("--ndcg_k",  type=int,   default=10)
+    ap.add_argument("--device",  choices=["cpu", "gpu"], default="cpu",
+                    help="LightGBM histogram backend")
     args = ap.parse_args()
 
     t0 = time.time()
@@ -142,6 +157,10 @@ def main():
     print(f"train rows  : {len(train_df):,}   groups : {len(train_grp):,}")
     print(f"valid rows  : {len(valid_df):,}   groups : {len(valid_grp):,}")
 
+    # The Datasets hold the only copies needed for training; drop the frames
+    del train_df, valid_df
+    gc.collect()
+
     # ── LightGBM parameters ─────────────────────────────────────
     params = dict(
         task               = "train",
@@ -157,10 +176,13 @@ def main():
         min_data_in_leaf   = 1,         # prevent empty-leaf errors
         lambda_l2          = 0.0,
         verbose            = -1,
-        deterministic      = True,     # ensure reproducibility
-        seed               = 42,
-        device_type        = "cpu",
+        seed               = 42,       # reproducible bagging / feature sampling
     )
+    if args.device == "gpu":
+        # GPU histograms need ≤255 bins and run fastest at 63
+        params.update(device_type="gpu", gpu_platform_id=0, gpu_device_id=0, max_bin=63)
+    else:
+        params.update(device_type="cpu", num_threads=os.cpu_count(), force_row_wise=True)
 
     # ── Train the LambdaRank model ──────────────────────────────
     print("training LightGBM …")
@@ -176,10 +198,14 @@ def main():
 
     # ── Evaluate final model ────────────────────────────────────
     print("evaluating final model …")
-    valid_df["pred"] = gbm.predict(
+    # Re-read the validation split (cheap next to training) and keep
+    # only the columns eval_metrics needs once predictions are attached
+    valid_df, _ = load_split(args.valid)
+    pred = gbm.predict(
         valid_df[feat_names].to_numpy(np.float32),
         num_iteration=gbm.best_iteration,
     )
+    valid_df = valid_df[["userId", "label"]].assign(pred=pred)
     mapk, ndcgk = eval_metrics(valid_df, k=args.ndcg_k)
     print(f"\nMAP@{args.ndcg_k}:  {mapk:.4f}")
     print(f"NDCG@{args.ndcg_k}: {ndcgk:.4f}")
@@ -11,7 +11,7 @@ import argparse, time
 import lightgbm as lgb
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
+from numba import njit, prange
 
 # ──────────────────────────────────────────────────────────────── 
 # helpers
@@ -31,43 +31,64 @@ def load_split(path: str):
     return df, feat_names
 
 
-def _dcg(rels: np.ndarray) -> float:
-    return float((rels / np.log2(np.arange(2, rels.size + 2))).sum())
+@njit(parallel=True, cache=True)
+def eval_kernel(starts, ends, label, pred, k, disc):
+    """Per-user AP@k and NDCG@k over contiguous user slices [starts, ends)"""
+    n_users = starts.size
+    ap   = np.zeros(n_users)
+    ndcg = np.zeros(n_users)
+    for u in prange(n_users):
+        lo, hi = starts[u], ends[u]
+        n_pos = 0
+        for i in range(lo, hi):
+            if label[i] > 0:
+                n_pos += 1
+        if n_pos == 0:                         # no positives → contributes 0
+            continue
+
+        # Bounded top-k by insertion sort (ties keep row order)
+        top = np.empty(k, dtype=np.int64)
+        m = 0
+        for i in range(lo, hi):
+            if m == k and pred[i] <= pred[top[m - 1]]:
+                continue
+            j = m if m < k else k - 1
+            while j > 0 and pred[top[j - 1]] < pred[i]:
+                top[j] = top[j - 1]
+                j -= 1
+            top[j] = i
+            if m < k:
+                m += 1
+
+        hits, ap_sum, dcg = 0, 0.0, 0.0
+        for r in range(m):
+            if label[top[r]] > 0:
+                hits += 1
+                ap_sum += hits / (r + 1)
+                dcg += disc[r]
+
+        n_rel = min(n_pos, k)
+        idcg = 0.0
+        for r in range(n_rel):
+            idcg += disc[r]
+        ap[u]   = ap_sum / n_rel
+        ndcg[u] = dcg / idcg
+    return ap, ndcg
 
 
 def eval_metrics(df_pred: pd.DataFrame, k: int = 10) -> tuple[float, float]:
     """MAP@k and NDCG@k averaged over users (binary relevance)"""
-    map_scores, ndcg_scores = [], []
-
-    for _, g in tqdm(df_pred.groupby("userId"), desc="eval", unit="usr", leave=False):
-        y_true = g["label"].to_numpy(dtype=np.int8, copy=False)
-        y_pred = g["pred"].to_numpy(copy=False)
-
-        if y_true.sum() == 0:                 # shouldn't happen, guard anyway
-            map_scores.append(0.0)
-            ndcg_scores.append(0.0)
-            continue
-
-        order = y_pred.argsort()[::-1]
-        topk  = order[:k]
-
-        # ---------- MAP@k ----------
-        hits = y_true[topk]
-        if hits.sum() == 0:
-            map_scores.append(0.0)
-        else:
-            cumsum = np.cumsum(hits)
-            precision_at_i = cumsum / (np.arange(k) + 1)
-            ap = (precision_at_i * hits).sum() / min(y_true.sum(), k)
-            map_scores.append(float(ap))
-
-        # ---------- NDCG@k ---------
-        dcg  = _dcg(y_true[topk])
-        ideal_topk = np.sort(y_true)[::-1][:k]
-        idcg = _dcg(ideal_topk)
-        ndcg_scores.append(dcg / idcg if idcg > 0 else 0.0)
-
-    return float(np.mean(map_scores)), float(np.mean(ndcg_scores))
+    df = df_pred.sort_values("userId", kind="stable")
+    if len(df) == 0:
+        return 0.0, 0.0
+
+    _, starts, sizes = np.unique(df["userId"].to_numpy(), return_index=True, return_counts=True)
+    disc = 1.0 / np.log2(np.arange(2, k + 2))  # shared DCG discounts
+    ap, ndcg = eval_kernel(starts, starts + sizes,
+                           df["label"].to_numpy(np.int8),
+                           df["pred"].to_numpy(np.float64),
+                           k, disc)
+    return float(ap.mean()), float(ndcg.mean())
 
 
 # ──────────────────────────────────────────────────────────────── 